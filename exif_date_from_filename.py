@@ -1,29 +1,163 @@
 #!/usr/bin/env python3
+import io
+import itertools
 import logging
+import mmap
+import multiprocessing
+import operator
 import os
 import re
+import string
+import struct
 import tempfile
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from pathlib import Path
 from datetime import datetime
-from typing import List
+from typing import List, Optional, Tuple
 
 import piexif
-import fire
-from tqdm import tqdm
-import yaml
 
 _LOGGER = logging.getLogger(__name__)
 
 VERSION = "0.2.0"
+DATE_TIME_ORIGINAL_TAG_INDEX = piexif.ExifIFD.DateTimeOriginal
 PROCESSED_TAG_INDEX = 0xfe69
 assert PROCESSED_TAG_INDEX not in piexif.ExifIFD.__dict__.values()
 piexif.TAGS["Exif"][PROCESSED_TAG_INDEX] = {"name": "ExifDateFromFilename", "type":piexif.TYPES.Undefined}
 PROCESSED_TAG_NON_VARIABLE = "exif_date_from_filename"
 PROCESSED_TAG = f"{PROCESSED_TAG_NON_VARIABLE}_v{VERSION}"
+# tag values are stored as bytes, compare against encoded constants instead of decoding every tag
+_PROCESSED_TAG_NON_VARIABLE_BYTES = PROCESSED_TAG_NON_VARIABLE.encode("ascii")
+_PROCESSED_TAG_BYTES = PROCESSED_TAG.encode("ascii")
+# tuple so that str.endswith can check all of them in one call
+IMAGE_EXTENSIONS = (
+    ".jpg",
+    ".jpeg",
+    ".tif",
+    ".webp",
+    ".tiff",
+    ".png",
+)
+
+
+# named groups a filename regex may capture, in the order RegexNameParser.date_from_match unpacks them
+DATE_GROUPS = ("year", "month", "day", "hour", "minute", "second", "microsecond", "millisecond")
+
+
+def date_group_getter(regex: re.Pattern, prefix: str = "") -> operator.itemgetter:
+    """
+    Build a getter that picks DATE_GROUPS out of match.groups() + (None,)
+    Groups the regex does not capture point to the appended None
+    """
+    return operator.itemgetter(*(
+        regex.groupindex[prefix + name] - 1 if prefix + name in regex.groupindex else -1
+        for name in DATE_GROUPS
+    ))
+
+
+def min_match_length(regex: re.Pattern) -> int:
+    """
+    Shortest string the regex can match (0 if it can not be determined)
+    Only a lower bound is useful: re.match ignores anything after the match, so there is no upper bound on the name
+    """
+    try:
+        # private, but the only way to get at the width computed by the regex compiler
+        return re._parser.parse(regex.pattern, regex.flags).getwidth()[0]
+    except Exception:
+        return 0
+
+
+def first_chars(regex: re.Pattern) -> Optional[frozenset]:
+    """
+    Characters a match of the regex can start with
+    None if a match may start with any character (or this can not be determined)
+    """
+    if regex.flags & re.IGNORECASE:
+        return None
+    try:
+        return _first_chars(re._parser.parse(regex.pattern, regex.flags), bool(regex.flags & re.ASCII))
+    except Exception:
+        return None
+
+
+def has_group_references(regex: re.Pattern) -> bool:
+    """
+    Whether the regex refers back to one of its groups, by name or number ((?P=name), \\2, (?(2)...))
+    Such a regex can not be joined into an alternation with other patterns, which renumbers its groups
+    True if this can not be determined
+    """
+    try:
+        return _has_group_references(re._parser.parse(regex.pattern, regex.flags))
+    except Exception:
+        return True
+
+
+def _has_group_references(item) -> bool:
+    constants = re._constants
+    if isinstance(item, re._parser.SubPattern):
+        return any(
+            op in (constants.GROUPREF, constants.GROUPREF_EXISTS) or _has_group_references(av)
+            for op, av in item
+        )
+    if isinstance(item, (list, tuple)):
+        # nested subpatterns, e.g. of groups, repeats and branches
+        return any(_has_group_references(sub_item) for sub_item in item)
+    return False
+
+
+# only valid for ASCII patterns, in unicode patterns \d and \w also match non-ASCII characters
+_CATEGORY_CHARS = {
+    re._constants.CATEGORY_DIGIT: frozenset(string.digits),
+    re._constants.CATEGORY_WORD: frozenset(string.ascii_letters + string.digits + "_"),
+}
+
+
+def _first_chars(subpattern, ascii: bool) -> Optional[frozenset]:
+    constants = re._constants
+    for op, av in subpattern:
+        if op is constants.AT:
+            # anchors do not consume a character
+            continue
+        if op is constants.LITERAL:
+            return frozenset(chr(av))
+        if op is constants.IN:
+            chars = set()
+            for item_op, item_av in av:
+                if item_op is constants.LITERAL:
+                    chars.add(chr(item_av))
+                elif item_op is constants.RANGE and item_av[1] - item_av[0] < 256:
+                    chars.update(map(chr, range(item_av[0], item_av[1] + 1)))
+                elif item_op is constants.CATEGORY and ascii and item_av in _CATEGORY_CHARS:
+                    chars.update(_CATEGORY_CHARS[item_av])
+                else:
+                    return None
+            return frozenset(chars)
+        if op in (constants.MAX_REPEAT, constants.MIN_REPEAT):
+            min_repeat, _, item = av
+            return _first_chars(item, ascii) if min_repeat > 0 else None
+        if op is constants.SUBPATTERN:
+            _, add_flags, _, item = av
+            if add_flags & re.IGNORECASE or item.getwidth()[0] == 0:
+                return None
+            return _first_chars(item, ascii or bool(add_flags & re.ASCII))
+        if op is constants.BRANCH:
+            chars = set()
+            for alternative in av[1]:
+                alternative_chars = _first_chars(alternative, ascii)
+                if alternative_chars is None:
+                    return None
+                chars.update(alternative_chars)
+            return frozenset(chars)
+        return None
+    return None
 
 
 class Parser:
+    # whether combine_parsers may merge this parser with its neighbours of the same kind
+    combinable = True
+
     def parse_date(self, filename: Path):
         raise NotImplementedError()
 
@@ -35,6 +169,16 @@ class RegexNameParser(Parser):
     """
     name: str
     regex: re.Pattern
+    group_getter: operator.itemgetter = field(init=False, repr=False)
+    min_length: int = field(init=False, repr=False)
+    first_chars: Optional[frozenset] = field(init=False, repr=False)
+    combinable: bool = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.group_getter = date_group_getter(self.regex)
+        self.min_length = min_match_length(self.regex)
+        self.first_chars = first_chars(self.regex)
+        self.combinable = not has_group_references(self.regex)
 
     @staticmethod
     def from_config(config: dict):
@@ -43,32 +187,122 @@ class RegexNameParser(Parser):
     def parse_date(self, filename: Path):
         _LOGGER.debug(f"Trying {self.name} filename parser")
         date_str = filename.stem
+        if len(date_str) < self.min_length or (self.first_chars is not None and date_str[:1] not in self.first_chars):
+            # can not match, no need to run the regex
+            return None
         match = self.regex.match(date_str)
         if not match:
             return None
-        groupdict = match.groupdict()
-        if groupdict.get("microsecond") is not None and groupdict.get("millisecond") is not None:
+        return self.date_from_match(match, self.group_getter)
+
+    def date_from_match(self, match: re.Match, group_getter: operator.itemgetter):
+        # a single C level lookup instead of one match.group call per date group
+        year, month, day, hour, minute, second, microsecond, millisecond = group_getter(match.groups() + (None,))
+        if microsecond is not None and millisecond is not None:
             _LOGGER.warning(f"Both microsecond and millisecond groups found in regex for {self.name}. Using microsecond group.")
         try:
             # Parse the date string
+            # positional arguments, datetime validates the ranges itself
             date_obj = datetime(
-                year=int(groupdict["year"]),
-                month=int(groupdict["month"]),
-                day=int(groupdict["day"]),
-                hour=int(groupdict.get("hour") or 0),
-                minute=int(groupdict.get("minute") or 0),
-                second=int(groupdict.get("second") or 0),
-                microsecond=(
-                    int(groupdict.get("microsecond") or 0)
-                    if groupdict.get("microsecond") is not None else
-                    int(groupdict.get("millisecond") or 0)*1000
-                ),
+                int(year),
+                int(month),
+                int(day),
+                int(hour or 0),
+                int(minute or 0),
+                int(second or 0),
+                int(microsecond) if microsecond is not None else int(millisecond or 0)*1000,
             )
             return date_obj
         except ValueError:
             return None
 
 
+@dataclass
+class CombinedRegexParser(Parser):
+    """
+    A class to try several RegexNameParsers with a single match
+    Their patterns are joined into one alternation (?P<p0>...)|(?P<p1>...) with prefixed group names,
+    so the first pattern that matches wins, just like trying the parsers one after the other
+    """
+    parsers: List[RegexNameParser]
+    regex: re.Pattern
+    # per parser: getter for its DATE_GROUPS in the combined regex
+    group_getters: List[operator.itemgetter]
+    # first character of the stem -> parser(s) whose patterns can start with it
+    by_first_char: dict = field(default_factory=dict, repr=False)
+    min_length: int = field(init=False, repr=False)
+    first_chars: Optional[frozenset] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.min_length = min(parser.min_length for parser in self.parsers)
+        if any(parser.first_chars is None for parser in self.parsers):
+            self.first_chars = None
+        else:
+            self.first_chars = frozenset().union(*(parser.first_chars for parser in self.parsers))
+
+    @staticmethod
+    def from_parsers(parsers: List[RegexNameParser], dispatch: bool = True):
+        alternatives = []
+        for i, parser in enumerate(parsers):
+            # the parsers have no group references (see combine_parsers), renaming the groups is enough
+            pattern = re.sub(r"\(\?P<(\w+)>", rf"(?P<p{i}_\1>", parser.regex.pattern)
+            alternatives.append(f"(?P<p{i}>{pattern})")
+        regex = re.compile("|".join(alternatives))
+        group_getters = [date_group_getter(regex, f"p{i}_") for i in range(len(parsers))]
+        by_first_char = CombinedRegexParser._first_char_dispatch(parsers) if dispatch else {}
+        if by_first_char:
+            # the dispatched parsers do the matching
+            return CombinedRegexParser(parsers, regex, group_getters, by_first_char)
+        return CombinedRegexParser(parsers, regex, group_getters)
+
+    @staticmethod
+    def _first_char_dispatch(parsers: List[RegexNameParser]) -> dict:
+        """
+        Map each possible first character to a parser for just the patterns that can start with it
+        (in config order), so e.g. names starting with a digit are never tried against IMG_... patterns
+        """
+        if any(parser.first_chars is None for parser in parsers):
+            return {}
+        chars_by_subset = {}
+        for char in frozenset().union(*(parser.first_chars for parser in parsers)):
+            subset = tuple(i for i, parser in enumerate(parsers) if char in parser.first_chars)
+            chars_by_subset.setdefault(subset, []).append(char)
+        if len(chars_by_subset) == 1:
+            # all patterns can start with the same characters, nothing to gain
+            return {}
+        by_first_char = {}
+        for subset, chars in chars_by_subset.items():
+            if len(subset) == 1:
+                parser = parsers[subset[0]]
+            else:
+                parser = CombinedRegexParser.from_parsers([parsers[i] for i in subset], dispatch=False)
+            for char in chars:
+                by_first_char[char] = parser
+        return by_first_char
+
+    def parse_date(self, filename: Path):
+        _LOGGER.debug("Trying combined filename parser")
+        stem = filename.stem
+        if len(stem) < self.min_length or (self.first_chars is not None and stem[:1] not in self.first_chars):
+            # can not match any of the patterns
+            return None
+        if self.by_first_char:
+            # the first character was checked against first_chars, so it has an entry
+            return self.by_first_char[stem[0]].parse_date(filename)
+        match = self.regex.match(stem)
+        if not match:
+            return None
+        # the outer group of the matching alternative is the last one to close
+        index = int(match.lastgroup[1:])
+        parser = self.parsers[index]
+        _LOGGER.debug(f"Filename matched {parser.name} filename parser")
+        date = parser.date_from_match(match, self.group_getters[index])
+        if date:
+            return date
+        # the matched date is invalid, the remaining parsers may still succeed
+        return parse_date_from_filename(self.parsers[index + 1:], filename)
+
+
 @dataclass
 class FolderNameParser(Parser):
     """
@@ -79,7 +313,17 @@ class FolderNameParser(Parser):
 
     @staticmethod
     def from_config(config: dict):
-        return FolderNameParser(config["folder_name"], config["date"])
+        date = config["date"]
+        try:
+            if isinstance(date, str):
+                # quoted dates ("2021-06-01") are loaded as strings
+                date = datetime.fromisoformat(date)
+            elif not isinstance(date, datetime):
+                # yaml loads plain dates (2021-06-01) as datetime.date
+                date = datetime(date.year, date.month, date.day)
+        except (AttributeError, ValueError):
+            raise ValueError(f"Invalid date {date!r} for folder parser {config['folder_name']!r}") from None
+        return FolderNameParser(config["folder_name"], date)
 
     def parse_date(self, filename: Path):
         _LOGGER.debug(f"Trying {self.folder_name} folder name parser")
@@ -87,6 +331,30 @@ class FolderNameParser(Parser):
             return self.date
 
 
+@dataclass
+class CombinedFolderParser(Parser):
+    """
+    A class to try several FolderNameParsers with one dict lookup per path component
+    If the path contains several of the folders, the parser listed first wins, just like trying them one after the other
+    """
+    parsers: List[FolderNameParser]
+    # folder name -> index of the first parser for that folder
+    folder_indices: dict
+
+    @staticmethod
+    def from_parsers(parsers: List[FolderNameParser]):
+        folder_indices = {}
+        for i, parser in enumerate(parsers):
+            folder_indices.setdefault(parser.folder_name, i)
+        return CombinedFolderParser(parsers, folder_indices)
+
+    def parse_date(self, filename: Path):
+        _LOGGER.debug("Trying combined folder name parser")
+        indices = [self.folder_indices[part] for part in filename.parts if part in self.folder_indices]
+        if indices:
+            return self.parsers[min(indices)].date
+
+
 def parse_date_from_filename(parsers: List[Parser], filename: Path):
     for parser in parsers:
         date = parser.parse_date(filename)
@@ -95,6 +363,160 @@ def parse_date_from_filename(parsers: List[Parser], filename: Path):
     return None
 
 
+def format_exif_date(date: datetime) -> str:
+    # EXIF date format, like date.strftime("%Y:%m:%d %H:%M:%S") but without interpreting the format on every call
+    return f"{date.year:04d}:{date.month:02d}:{date.day:02d} {date.hour:02d}:{date.minute:02d}:{date.second:02d}"
+
+
+def _can_insert_exif(image_data: bytes) -> bool:
+    # same magic numbers piexif.insert checks for
+    return image_data[0:2] == b"\xff\xd8" or (image_data[0:4] == b"RIFF" and image_data[8:12] == b"WEBP")
+
+
+def _load_exif(image_path: Path) -> dict:
+    # Load the EXIF data directly from the file.
+    # For JPEGs this only reads the header segments, so files that are
+    # skipped are never read in full.
+    try:
+        return piexif.load(str(image_path))
+    except piexif.InvalidImageDataError:
+        _LOGGER.debug(f"No existing EXIF data in {image_path}. Creating new EXIF data.")
+        return {"0th": {}, "1st": {}, "Exif": {}, "GPS": {}, "Interop": {}}
+
+
+# tags _needs_write looks at, the only ones _read_exif_tags extracts
+_CHECKED_TAG_INDICES = (DATE_TIME_ORIGINAL_TAG_INDEX, PROCESSED_TAG_INDEX)
+_EXIF_IFD_POINTER_TAG_INDEX = piexif.ImageIFD.ExifTag
+
+
+def _ifd_entries(tiff, endian: str, pointer: int):
+    """
+    Yield (tag, value type, value count, offset of the value field) for each entry of the IFD at pointer
+    """
+    tag_count = struct.unpack(endian + "H", tiff[pointer:pointer + 2])[0]
+    for entry in range(pointer + 2, pointer + 2 + 12 * tag_count, 12):
+        tag, value_type, value_count = struct.unpack(endian + "HHL", tiff[entry:entry + 8])
+        yield tag, value_type, value_count, entry + 8
+
+
+def _read_exif_tags(data) -> Optional[dict]:
+    """
+    Read only the tags checked by _needs_write from the Exif IFD of a JPEG, without a full piexif.load
+    Meant for memory mapped files, so only the pages holding the header are actually read.
+    Returns an exif dict like piexif.load, restricted to those tags, or None if the data can not be handled this way
+    """
+    try:
+        if data[0:2] != b"\xff\xd8":
+            return None
+        # walk the JPEG segments up to the EXIF APP1 segment
+        offset = 2
+        while True:
+            marker = data[offset:offset + 2]
+            if len(marker) < 2 or marker[0] != 0xff or marker == b"\xff\xda":
+                # start of scan (or garbage): there is no EXIF segment
+                return {"Exif": {}}
+            length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+            if marker == b"\xff\xe1" and data[offset + 4:offset + 10] == b"Exif\x00\x00":
+                tiff = data[offset + 10:offset + 2 + length]
+                break
+            offset += 2 + length
+        endian = "<" if tiff[0:2] == b"II" else ">"
+        exif_pointer = None
+        for tag, value_type, value_count, value_offset in _ifd_entries(tiff, endian, struct.unpack(endian + "L", tiff[4:8])[0]):
+            if tag == _EXIF_IFD_POINTER_TAG_INDEX:
+                exif_pointer = struct.unpack(endian + "L", tiff[value_offset:value_offset + 4])[0]
+        tags = {}
+        if exif_pointer is not None:
+            for tag, value_type, value_count, value_offset in _ifd_entries(tiff, endian, exif_pointer):
+                if tag not in _CHECKED_TAG_INDICES:
+                    continue
+                if value_type not in (piexif.TYPES.Ascii, piexif.TYPES.Undefined):
+                    return None
+                if value_count > 4:
+                    value_offset = struct.unpack(endian + "L", tiff[value_offset:value_offset + 4])[0]
+                value = tiff[value_offset:value_offset + value_count]
+                # like piexif, drop the terminating NUL of ASCII values
+                tags[tag] = value[:-1] if value_type == piexif.TYPES.Ascii else value
+        return {"Exif": tags}
+    except (ValueError, struct.error):
+        # e.g. truncated headers
+        return None
+
+
+def _needs_write(exif_dict: dict, date_taken_bytes: bytes, update: bool, force: bool) -> bool:
+    exif_ifd = exif_dict["Exif"]
+    # Check if DateTimeOriginal tag is already set
+    date_time_original = exif_ifd.get(DATE_TIME_ORIGINAL_TAG_INDEX)
+    if date_time_original is None:
+        return True
+    # and was written by us
+    written_by_us = exif_ifd.get(PROCESSED_TAG_INDEX, b"").startswith(_PROCESSED_TAG_NON_VARIABLE_BYTES)
+    if written_by_us and date_time_original == date_taken_bytes:
+        # we already wrote exactly this date, rewriting would not change anything
+        return False
+    return (written_by_us and update) or force
+
+
+def _needs_update(parsers: List[Parser], image_path: Path, update: bool, force: bool) -> bool:
+    """
+    Cheap check whether update_exif_date would write to the image, reading at most its EXIF header
+    """
+    date_taken = parse_date_from_filename(parsers, image_path)
+    if not date_taken:
+        _LOGGER.debug(f"Could not parse date from filename: {image_path}")
+        return False
+    try:
+        with open(image_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if not _can_insert_exif(data):
+                # update_exif_date would refuse it anyway, no need to hand it to a worker process
+                _LOGGER.warning(f"Writing EXIF data is only supported for JPEG and WebP files, skipping {image_path}")
+                return False
+            exif_dict = _read_exif_tags(data)
+        if exif_dict is None:
+            exif_dict = _load_exif(image_path)
+        if _needs_write(exif_dict, format_exif_date(date_taken).encode("utf-8"), update, force):
+            return True
+    except Exception:
+        # let update_exif_date report the error
+        return True
+    _LOGGER.debug(f"EXIF date already set for {image_path}")
+    return False
+
+
+def _replace_via_tmpfile(image_path: Path, data: bytes) -> bool:
+    """
+    Atomically replace the file with the given data, using an anonymous O_TMPFILE (Linux only)
+    The new file only gets a name once it is completely written, so an interrupted run leaves no partial temp file behind
+    Returns False if this is not supported, the caller should then fall back to a named temp file
+    """
+    if not hasattr(os, "O_TMPFILE"):
+        return False
+    dir_fd = os.open(image_path.parent, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        try:
+            fd = os.open(".", os.O_TMPFILE | os.O_WRONLY, os.stat(image_path).st_mode & 0o777, dir_fd=dir_fd)
+        except OSError:
+            # e.g. the file system does not support O_TMPFILE
+            return False
+        tmp_name = f".{image_path.name}.{os.getpid()}.tmp"
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            try:
+                # give the anonymous file a name (requires /proc, linkat has to follow the fd symlink)
+                os.link(f"/proc/self/fd/{fd}", tmp_name, dst_dir_fd=dir_fd, follow_symlinks=True)
+            except OSError:
+                return False
+        try:
+            os.replace(tmp_name, image_path.name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except BaseException:
+            os.remove(tmp_name, dir_fd=dir_fd)
+            raise
+        return True
+    finally:
+        os.close(dir_fd)
+
+
 def update_exif_date(parsers: List[Parser], image_path: Path, dry_run: bool = False, update: bool = False, force: bool = False) -> bool:
     # Parse date from filename (assumed to be faster than actually opening the image)
     date_taken = parse_date_from_filename(parsers, image_path)
@@ -105,40 +527,37 @@ def update_exif_date(parsers: List[Parser], image_path: Path, dry_run: bool = Fa
         _LOGGER.info(f"Would update EXIF date for {image_path} to {date_taken}")
         return False
     try:
-        # Read the entire image file into memory as raw bytes.
-        with open(image_path, 'rb') as f:
-            image_data = f.read()
+        exif_dict = _load_exif(image_path)
+        date_taken_bytes = format_exif_date(date_taken).encode("utf-8")
 
-        # Load the EXIF data from the in-memory bytes.
-        try:
-            exif_dict = piexif.load(image_data)
-        except piexif.InvalidImageDataError:
-            _LOGGER.debug(f"No existing EXIF data in {image_path}. Creating new EXIF data.")
-            exif_dict = {"0th": {}, "1st": {}, "Exif": {}, "GPS": {}, "Interop": {}}
-
-        # Check if DateTimeOriginal tag is already set
-        # and was written by us
-        if piexif.ExifIFD.DateTimeOriginal not in exif_dict["Exif"] or (
-           exif_dict["Exif"].get(PROCESSED_TAG_INDEX, b"").decode("ascii").startswith(PROCESSED_TAG_NON_VARIABLE) and update
-        ) or force:
+        if _needs_write(exif_dict, date_taken_bytes, update, force):
             _LOGGER.debug(f"Writing EXIF date for {image_path}")
 
             # Set the DateTimeOriginal tag
-            date_taken_fmt = date_taken.strftime("%Y:%m:%d %H:%M:%S")
-            exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = date_taken_fmt.encode(
-                "utf-8"
-            )
+            exif_dict["Exif"][DATE_TIME_ORIGINAL_TAG_INDEX] = date_taken_bytes
             # Add processed tag
-            exif_dict["Exif"][PROCESSED_TAG_INDEX] = PROCESSED_TAG.encode("ascii")
+            exif_dict["Exif"][PROCESSED_TAG_INDEX] = _PROCESSED_TAG_BYTES
 
             # Save the updated EXIF data (atomic, to avoid corrupting the image)
             exif_bytes = piexif.dump(exif_dict)
+            # Read the entire image file into memory as raw bytes.
+            with open(image_path, 'rb') as f:
+                image_data = f.read()
+            if not _can_insert_exif(image_data):
+                # piexif can only splice the EXIF segment into JPEG and WebP, never re-encode the image
+                _LOGGER.warning(f"Writing EXIF data is only supported for JPEG and WebP files, skipping {image_path}")
+                return False
+            # Create the new image file data by inserting the new EXIF into the original data
+            new_image = io.BytesIO()
+            piexif.insert(exif_bytes, image_data, new_image)
+            if _replace_via_tmpfile(image_path, new_image.getvalue()):
+                _LOGGER.info(f"Updated EXIF date for {image_path} to {date_taken}")
+                return True
             # Write the new data to a temp file (to ensure atomicity)
             with tempfile.NamedTemporaryFile(
                 delete=False, suffix=image_path.suffix, dir=image_path.parent
             ) as tmp:
-                # Create the new image file data by inserting the new EXIF into the original data
-                piexif.insert(exif_bytes, image_data, tmp.name)
+                tmp.write(new_image.getvalue())
             
             # Atomically replace the original file with the new one.
             
@@ -179,64 +598,222 @@ PARSER_CLASSES = {
     "folder": FolderNameParser,
 }
 
+COMBINED_PARSER_CLASSES = {
+    RegexNameParser: CombinedRegexParser,
+    FolderNameParser: CombinedFolderParser,
+}
+
 def load_config(config:str):
+    # parsing the yaml and compiling the regexes is only redone when the config changes
+    return list(_load_config_cached(os.path.abspath(config), os.stat(config).st_mtime_ns))
+
+
+@lru_cache(maxsize=4)
+def _load_config_cached(config: str, mtime_ns: int):
+    # only imported where needed, so spawned worker processes do not pay for it
+    import yaml
     with open(config, "r") as ymlfile:
         cfg = yaml.safe_load(ymlfile)
     parsers = []
     for entry in cfg:
         parser_class = PARSER_CLASSES[entry["parser"]].from_config(entry)
         parsers.append(parser_class)
-    return parsers
+    return combine_parsers(parsers)
+
+
+def combine_parsers(parsers: List[Parser]):
+    """
+    Merge each run of consecutive parsers of the same kind into a single combined parser
+    (keeps the order of the config intact)
+    """
+    combined = []
+    # a parser that can not be combined forms a run of its own
+    runs = itertools.groupby(parsers, key=lambda parser: type(parser) if parser.combinable else id(parser))
+    for parser_class, run in runs:
+        run = list(run)
+        combined_class = COMBINED_PARSER_CLASSES.get(parser_class)
+        if combined_class is None or len(run) == 1:
+            combined.extend(run)
+            continue
+        try:
+            combined.append(combined_class.from_parsers(run))
+        except re.error as e:
+            # e.g. global inline flags that are only allowed at the start of a pattern
+            _LOGGER.debug(f"Could not combine parsers: {str(e)}")
+            combined.extend(run)
+    return combined
+
+
+# threads used to check which images need to be updated at all
+PREFILTER_THREADS = 8
+# Worker processes may be started while the pre-filter threads are running,
+# and forking a multi-threaded process can deadlock the child
+_WORKER_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# images handed to a worker process at once
+WORKER_CHUNKSIZE = 16
+# parsers are handed to each worker once via the pool initializer instead of being pickled per task
+_WORKER_PARSERS: List[Parser] = []
+
+
+def _setup_logging(verbosity: int):
+    # cursed logging setup
+    if _LOGGER.handlers:
+        # already configured (e.g. worker forked from the main process)
+        return
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    handler.setLevel(verbosity)
+    _LOGGER.setLevel(verbosity)
+    _LOGGER.addHandler(handler)
+
+
+# the inode number comes with the directory listing on POSIX, on Windows it needs an extra stat call per file
+_SORT_BY_INODE = os.name != "nt"
+
+
+def _walk_images(directory: str):
+    """
+    Yield each directory (top-down) together with the names of the images it contains
+    Uses os.scandir, whose entries know their file type without an extra stat call per file,
+    and an explicit stack instead of recursion, so deep trees neither hit the recursion limit
+    nor pass every result up through a chain of nested generators
+    """
+    stack = [directory]
+    while stack:
+        directory = stack.pop()
+        dir_paths = []
+        image_entries = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_paths.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        image_entries.append(entry)
+        except OSError as e:
+            # like os.walk, skip directories that can not be listed
+            _LOGGER.warning(f"Could not list directory {directory}: {str(e)}")
+            continue
+        if _SORT_BY_INODE:
+            # files created together usually sit close together on disk,
+            # reading their headers in inode order lets readahead coalesce the I/O
+            image_entries.sort(key=os.DirEntry.inode)
+        yield Path(directory), [entry.name for entry in image_entries]
+        # reversed, so subdirectories are popped in listing order
+        stack.extend(reversed(dir_paths))
+
+
+def _init_worker(parsers: List[Parser], verbosity: int):
+    global _WORKER_PARSERS
+    _WORKER_PARSERS = parsers
+    _setup_logging(verbosity)
+
+
+def _process_file(args: Tuple[Path, bool, bool]) -> Tuple[Path, bool]:
+    image_path, update, force = args
+    _LOGGER.debug(f"Processing file: {image_path}")
+    return image_path, update_exif_date(_WORKER_PARSERS, image_path, False, update, force)
+
+
+def _update_images(
+    parsers: List[Parser], image_paths: List[Path], verbosity: int, update: bool, force: bool, workers: Optional[int],
+) -> set:
+    """
+    Write the EXIF date of the given images with a pool of worker processes
+    Returns the directories that contain updated images
+    """
+    if verbosity > logging.INFO:
+        from tqdm import tqdm
+
+    updated_dirs = set()
+    tasks = ((image_path, update, force) for image_path in image_paths)
+    with ThreadPoolExecutor(max_workers=PREFILTER_THREADS) as prefilter_executor:
+        if not force:
+            # Most images of a re-run are already tagged. Checking them only needs the EXIF header,
+            # which threads can read concurrently (the GIL is released during file I/O),
+            # so only images that actually need a write are handed to the worker processes.
+            # The check and the writes run as a pipeline: images are handed over as soon as they pass.
+            needed = prefilter_executor.map(partial(_needs_update, parsers, update=update, force=force), image_paths)
+            if verbosity > logging.INFO:
+                needed = tqdm(needed, total=len(image_paths))
+            tasks = (task for task, need in zip(tasks, needed) if need)
+        max_workers = workers or os.cpu_count() or 1
+        # Wait for enough images to keep every worker busy before starting the worker processes,
+        # so a re-run with a handful of new images does not start one process per core (and none if there is nothing to write)
+        buffered_tasks = list(itertools.islice(tasks, max_workers * WORKER_CHUNKSIZE))
+        if buffered_tasks:
+            # no point in starting more processes than there are chunks of work
+            chunk_count = -(-len(buffered_tasks) // WORKER_CHUNKSIZE)
+            with ProcessPoolExecutor(
+                max_workers=min(max_workers, chunk_count),
+                mp_context=_WORKER_CONTEXT,
+                initializer=_init_worker, initargs=(parsers, verbosity),
+            ) as executor:
+                # zip stops at the end of the tasks, so the counter ends up at the number of tasks
+                task_counter = itertools.count()
+                results = executor.map(
+                    _process_file,
+                    (task for task, _ in zip(itertools.chain(buffered_tasks, tasks), task_counter)),
+                    chunksize=WORKER_CHUNKSIZE,
+                )
+                if verbosity > logging.INFO:
+                    # should add a progress bar if verbosity is high
+                    # (map submits every task before it returns, so their number is known by now)
+                    results = tqdm(results, total=next(task_counter))
+                for image_path, updated in results:
+                    if updated:
+                        updated_dirs.add(image_path.parent)
+    return updated_dirs
 
 
 def process_directory(
-    directory: str, verbosity: int = logging.INFO, config:str = "./config.yml", wet_run: bool = False, update: bool= False, force: bool = False
+    directory: str, *directories: str, verbosity: int = logging.INFO, config:str = "./config.yml", wet_run: bool = False, update: bool= False, force: bool = False,
+    workers: Optional[int] = None, sort: bool = False,
 ):
     """
-    Process all images in the given directory and update their EXIF date based on filename, if missing
+    Process all images in the given directories and update their EXIF date based on filename, if missing
     :param directory: Directory containing images
+    :param directories: Further directories containing images
     :param verbosity: Logging verbosity level
     :param wet_run: Perform the actual update (default is dry run)
     :param update: Overwrite tags that were written by us
     :param force: Force update even if DateTimeOriginal tag is already set by external software
     :param config: Path to the config file
+    :param workers: Number of worker processes (default is the number of CPUs)
+    :param sort: Process the files of each directory in name order, default is inode order where available (only dry runs log in processing order, the workers of a wet run log in parallel)
     """
-    # cursed logging setup
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    handler.setLevel(verbosity)
-    _LOGGER.setLevel(verbosity)
-    _LOGGER.addHandler(handler)
+    _setup_logging(verbosity)
+    if verbosity > logging.INFO:
+        # progress bars are only shown at high verbosity, skip the import otherwise
+        from tqdm import tqdm
 
     parsers = load_config(config)
 
-    # actual processing
-    # Use os.walk instead of Path.walk() for Python 3.11 compatibility
-    dir_path_obj = Path(directory)
-    walk_iter = os.walk(dir_path_obj)
+    # collect candidate images first, then process them in parallel
+    image_paths = []
+    walk_iter = itertools.chain.from_iterable(_walk_images(path) for path in (directory, *directories))
     if verbosity > logging.INFO:
-        # should add a progress bar if verbosity is high
-        walk_iter = tqdm(list(walk_iter))
-    updated_dirs = set()
-    for root, dir_names, file_names in walk_iter:
-        dir_path = Path(root)
-        _LOGGER.info(f"Processing directory: {dir_path}")
-        for filename in sorted(file_names):
-            if Path(filename).suffix.lower() not in [
-                ".jpg",
-                ".jpeg",
-                ".tif",
-                ".webp",
-                ".tiff",
-                ".png",
-            ]:
-                continue
-            _LOGGER.debug(f"Processing file: {filename}")
-            image_path = dir_path / filename
-            updated = update_exif_date(parsers, image_path, not wet_run, update, force)
-            if updated:
-                updated_dirs.add(dir_path)
+        # stream the walk instead of listing the whole tree first, the total is unknown until it is done
+        walk_iter = tqdm(walk_iter, unit="dir")
+    for dir_path, file_names in walk_iter:
+        if sort:
+            file_names.sort()
+        if not wet_run:
+            # a dry run only parses file names, handing them to worker processes would cost more than it saves
+            _LOGGER.info(f"Processing directory: {dir_path}")
+            for filename in file_names:
+                _LOGGER.debug(f"Processing file: {filename}")
+                update_exif_date(parsers, dir_path / filename, dry_run=True)
+            continue
+        _LOGGER.info(f"Collecting images in directory: {dir_path}")
+        for filename in file_names:
+            image_paths.append(dir_path / filename)
+
+    # a dry run is done once the tree is walked
+    updated_dirs = _update_images(parsers, image_paths, verbosity, update, force, workers) if wet_run else set()
     _LOGGER.info("Done!")
     if updated_dirs:
         _LOGGER.info("Dumping updated directories to stdout")
@@ -248,4 +825,5 @@ def process_directory(
 
 # Usage
 if __name__ == "__main__":
+    import fire
     fire.Fire(process_directory)
@@ -0,0 +1,173 @@
+import re
+import struct
+from pathlib import Path
+
+import piexif
+import pytest
+import yaml
+
+import exif_date_from_filename as edff
+
+
+def regex_parser(name: str, regex: str) -> edff.RegexNameParser:
+    return edff.RegexNameParser.from_config({"name": name, "regex": regex})
+
+
+def test_numbered_backreference_is_not_combined():
+    parsers = [
+        regex_parser("compact", r"(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})_"),
+        regex_parser("separated", r"(?P<year>\d{4})([-_])(?P<month>\d{2})\2(?P<day>\d{2})"),
+    ]
+    combined = edff.combine_parsers(parsers)
+    assert combined == parsers
+    for name in ("2020-01-02.jpg", "2020_01_02.jpg"):
+        assert edff.parse_date_from_filename(combined, Path(name)) == edff.datetime(2020, 1, 2)
+    assert edff.parse_date_from_filename(combined, Path("2020-01_02.jpg")) is None
+
+
+def test_group_references_are_detected():
+    assert edff.has_group_references(re.compile(r"(\d)\1"))
+    assert edff.has_group_references(re.compile(r"(?P<year>\d{4})-(?P=year)"))
+    assert edff.has_group_references(re.compile(r"(-)?\d{4}(?(1)-)"))
+    assert not edff.has_group_references(re.compile(r"(?P<year>\d{4})(-|_)(?P<month>\d{2})"))
+
+
+def test_combined_parsers_agree_with_sequential_parsers():
+    parsers = edff.load_config(str(Path(__file__).with_name("config.yml")))
+    sequential = [
+        parser
+        for combined in parsers
+        for parser in getattr(combined, "parsers", [combined])
+    ]
+    names = [
+        "2013-03-07 16.28.22.jpg",
+        "IMG-20151101-WA0001.jpg",
+        "IMG_20191209_043621.vr.jpg",
+        "20110320_203536_B8E3D877.jpg",
+        "20111320_203536_B8E3D877.jpg",
+        "signal-2021-06-13-20-33-04-997.jpg",
+        "threema-20220412-084636799.jpg",
+        "randomname.jpg",
+    ]
+    for name in names:
+        assert edff.parse_date_from_filename(parsers, Path(name)) == edff.parse_date_from_filename(sequential, Path(name))
+
+
+def test_default_config_keeps_unicode_semantics():
+    parsers = edff.load_config(str(Path(__file__).with_name("config.yml")))
+    for name in (
+        "Screenshot_Café_20220926-211023.jpg",
+        "Screenshot_Телеграм_20220926-211023.png",
+        "２０２２０９２６_２１１０２３_B8E3D877.jpg",
+    ):
+        assert edff.parse_date_from_filename(parsers, Path(name)) == edff.datetime(2022, 9, 26, 21, 10, 23)
+
+
+def test_first_chars_of_unicode_categories():
+    assert edff.first_chars(re.compile(r"IMG_\d")) == frozenset("I")
+    assert edff.first_chars(re.compile(r"\d{4}")) is None
+    assert edff.first_chars(re.compile(r"\d{4}", re.ASCII)) == frozenset("0123456789")
+    assert edff.first_chars(re.compile(r"(?a:\w)")) is not None
+
+
+def test_folder_dates():
+    entries = yaml.safe_load("""
+- {parser: folder, folder_name: Plain, date: 2021-06-01}
+- {parser: folder, folder_name: Quoted, date: "2021-06-01"}
+- {parser: folder, folder_name: Time, date: 2021-06-01 12:30:00}
+""")
+    dates = [edff.FolderNameParser.from_config(entry).date for entry in entries]
+    assert dates == [edff.datetime(2021, 6, 1), edff.datetime(2021, 6, 1), edff.datetime(2021, 6, 1, 12, 30)]
+    for date in ("June 2021", 20210601):
+        with pytest.raises(ValueError, match="Broken"):
+            edff.FolderNameParser.from_config({"parser": "folder", "folder_name": "Broken", "date": date})
+
+
+def test_prefilter_skips_formats_that_can_not_be_written(tmp_path):
+    parsers = [regex_parser("compact", r"(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})")]
+    png = tmp_path / "20200102.png"
+    png.write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(16))
+    jpeg = tmp_path / "20200102.jpg"
+    jpeg.write_bytes(b"\xff\xd8\xff\xda" + bytes(16))
+    assert not edff._needs_update(parsers, png, update=False, force=False)
+    assert edff._needs_update(parsers, jpeg, update=False, force=False)
+
+
+DATE_TIME_ORIGINAL = edff.DATE_TIME_ORIGINAL_TAG_INDEX
+PROCESSED = edff.PROCESSED_TAG_INDEX
+
+
+def tiff_with_exif_ifd(endian: str, exif_entries, exif_pointer: bool = True) -> bytes:
+    """
+    Lay out a TIFF header, IFD0 and an Exif IFD by hand; piexif.dump only ever writes big-endian data
+    exif_entries are (tag, value type, value) with the raw value bytes, the value count is its length in bytes
+    """
+    ifd0_size = 2 + 12 + 4
+    exif_offset = 8 + ifd0_size
+    if exif_pointer:
+        ifd0_entry = struct.pack(endian + "HHLL", piexif.ImageIFD.ExifTag, piexif.TYPES.Long, 1, exif_offset)
+    else:
+        ifd0_entry = struct.pack(endian + "HHLL", piexif.ImageIFD.ImageWidth, piexif.TYPES.Long, 1, 8)
+    tiff = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HL", 42, 8)
+    tiff += struct.pack(endian + "H", 1) + ifd0_entry + struct.pack(endian + "L", 0)
+    data_offset = exif_offset + 2 + 12 * len(exif_entries) + 4
+    entries, data = b"", b""
+    for tag, value_type, value in exif_entries:
+        if len(value) <= 4:
+            # values of up to 4 bytes are stored inline in the entry
+            field = value.ljust(4, b"\x00")
+        else:
+            field = struct.pack(endian + "L", data_offset + len(data))
+            data += value
+        entries += struct.pack(endian + "HHL", tag, value_type, len(value)) + field
+    tiff += struct.pack(endian + "H", len(exif_entries)) + entries + struct.pack(endian + "L", 0) + data
+    return tiff
+
+
+def jpeg_with_exif(tiff: bytes) -> bytes:
+    app1 = b"Exif\x00\x00" + tiff
+    return b"\xff\xd8\xff\xe1" + struct.pack(">H", 2 + len(app1)) + app1 + b"\xff\xda\x00\x02\xff\xd9"
+
+
+def checked_tags(exif_dict: dict) -> dict:
+    return {tag: value for tag, value in exif_dict["Exif"].items() if tag in edff._CHECKED_TAG_INDICES}
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+@pytest.mark.parametrize("processed", [b"abcd", edff._PROCESSED_TAG_BYTES], ids=["inline", "offset"])
+def test_read_exif_tags_agrees_with_piexif(endian, processed):
+    data = jpeg_with_exif(tiff_with_exif_ifd(endian, [
+        (piexif.ExifIFD.ExifVersion, piexif.TYPES.Undefined, b"0232"),
+        (piexif.ExifIFD.UserComment, piexif.TYPES.Undefined, b"ASCII\x00\x00\x00comment"),
+        (DATE_TIME_ORIGINAL, piexif.TYPES.Ascii, b"2020:01:02 03:04:05\x00"),
+        (PROCESSED, piexif.TYPES.Undefined, processed),
+    ]))
+    tags = edff._read_exif_tags(data)
+    assert tags["Exif"] == {DATE_TIME_ORIGINAL: b"2020:01:02 03:04:05", PROCESSED: processed}
+    assert tags["Exif"] == checked_tags(piexif.load(data))
+
+
+def test_read_exif_tags_agrees_with_piexif_dump():
+    exif_bytes = piexif.dump({"0th": {piexif.ImageIFD.Make: b"Camera"}, "Exif": {
+        DATE_TIME_ORIGINAL: b"2020:01:02 03:04:05",
+        PROCESSED: edff._PROCESSED_TAG_BYTES,
+    }})
+    data = jpeg_with_exif(exif_bytes[len(b"Exif\x00\x00"):])
+    assert edff._read_exif_tags(data)["Exif"] == checked_tags(piexif.load(data))
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_read_exif_tags_without_exif_ifd(endian):
+    data = jpeg_with_exif(tiff_with_exif_ifd(endian, [], exif_pointer=False))
+    assert edff._read_exif_tags(data) == {"Exif": {}}
+    assert checked_tags(piexif.load(data)) == {}
+    assert edff._read_exif_tags(b"\xff\xd8\xff\xda\x00\x02") == {"Exif": {}}
+
+
+def test_read_exif_tags_falls_back_for_unexpected_types():
+    data = jpeg_with_exif(tiff_with_exif_ifd("<", [
+        (DATE_TIME_ORIGINAL, piexif.TYPES.Byte, b"2020:01:02 03:04:05\x00"),
+    ]))
+    assert edff._read_exif_tags(data) is None
+    # not a JPEG, piexif.load has to handle it
+    assert edff._read_exif_tags(b"RIFF\x00\x00\x00\x00WEBP") is None